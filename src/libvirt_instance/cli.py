@@ -2,38 +2,74 @@
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
 import argparse
-import importlib.metadata
+import contextlib
+import functools
 import logging
 import sys
-import uuid
 from pathlib import Path
-from typing import Any, Optional
+from typing import TYPE_CHECKING, Any, Callable, Optional
 
-import libvirt  # type: ignore
-import yaml
+from libvirt_instance import output, util
 
-from libvirt_instance import output, seed_image, util
-from libvirt_instance.config import Config
-from libvirt_instance.domain import DomainDefinition, Volume
+if TYPE_CHECKING:
+    from libvirt_instance.config import Config
 
 logger = logging.getLogger(__name__)
 
+# Spec keys which may override preset values, grouped by value type.
+DISK_STR_KEYS = frozenset(
+    (
+        "pool",
+        "bus",
+        "cache",
+        "source",
+        "source-pool",
+        "encryption-format",
+        "encryption-secret",
+        "encryption-cipher",
+        "encryption-ivgen",
+    )
+)
+DISK_INT_KEYS = frozenset(("boot-order",))
+DISK_BOOL_KEYS = frozenset(("exist-ok",))
+
+NIC_STR_KEYS = frozenset(("model-type", "network", "bridge", "mac-address"))
+NIC_INT_KEYS = frozenset(("boot-order", "mtu"))
+
+LOG_LEVELS = {
+    name: logging.getLevelName(name)
+    for name in ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET")
+}
+
 
 class CliError(Exception):
     pass
 
 
+class LazyDescriptionParser(argparse.ArgumentParser):
+    """
+    Argument parser which looks up the package summary for its description
+    only when the help is actually rendered.
+    """
+
+    def format_help(self) -> str:
+        if self.description is None:
+            self.description = package_metadata()["Summary"]
+
+        return super().format_help()
+
+
 def parse_spec(spec: str) -> tuple:
     args = []
     kwargs: dict = {}
 
     if spec:
         for item in spec.split(","):
-            parts = item.split("=", 1)
-            if len(parts) == 1:
-                args.append(parts[0])
+            key, sep, value = item.partition("=")
+            if sep:
+                kwargs[key] = value
             else:
-                kwargs[parts[0]] = parts[1]
+                args.append(key)
 
     return args, kwargs
 
@@ -73,44 +109,19 @@ def parse_ivgen(ivgen: str) -> dict:
     return {"name": name, "hash": hash}
 
 
-def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(
-        prog="libvirt-instance",
-        description=importlib.metadata.metadata("libvirt-instance")["Summary"],
-    )
-
-    parser.add_argument(
-        "--log-level",
-        default="WARNING",
-        choices=("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"),
-        help="log level",
-    )
-
-    parser.add_argument(
-        "--output-format", default="json", choices=("json",), help="output format"
-    )
-
-    parser.add_argument(
-        "--config-file",
-        type=Path,
-        default=Path("/etc/libvirt-instance-config.yaml"),
-        help="location of the configuration file",
-    )
-
-    parser.add_argument(
-        "--connect", "-c", default="qemu:///system", help="libvirt connection string"
-    )
+def package_metadata() -> Any:
+    import importlib.metadata
 
-    subparsers = parser.add_subparsers(
-        dest="command", required=True, help="sub-command help"
-    )
+    return importlib.metadata.metadata("libvirt-instance")
 
-    subparsers.add_parser("version", help="show version")
 
-    subparsers.add_parser("get-domain-presets", help="list all domain presets")
+def package_version() -> str:
+    return package_metadata()["Version"]
 
-    subparsers.add_parser("get-config", help="show current config")
 
+def add_create_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     parser_create = subparsers.add_parser("create", help="create a VM")
 
     parser_create.add_argument("name", help="VM name")
@@ -188,10 +199,59 @@ def parse_args() -> argparse.Namespace:
         help="location of the cloud-init network-config file; needs --cloud-seed-disk",
     )
 
-    return parser.parse_args()
 
+@functools.cache
+def build_parser() -> argparse.ArgumentParser:
+    parser = LazyDescriptionParser(prog="libvirt-instance")
+
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        choices=LOG_LEVELS,
+        help="log level",
+    )
+
+    parser.add_argument(
+        "--output-format",
+        default="json",
+        choices=output.FORMATTERS,
+        help="output format",
+    )
+
+    parser.add_argument(
+        "--config-file",
+        type=Path,
+        default=Path("/etc/libvirt-instance-config.yaml"),
+        help="location of the configuration file",
+    )
 
-def cmd_get_domain_presets(args: argparse.Namespace, config: Config):
+    parser.add_argument(
+        "--connect", "-c", default="qemu:///system", help="libvirt connection string"
+    )
+
+    subparsers = parser.add_subparsers(
+        dest="command",
+        required=True,
+        help="sub-command help",
+        parser_class=argparse.ArgumentParser,
+    )
+
+    subparsers.add_parser("version", help="show version")
+
+    subparsers.add_parser("get-domain-presets", help="list all domain presets")
+
+    subparsers.add_parser("get-config", help="show current config")
+
+    add_create_parser(subparsers)
+
+    return parser
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    return build_parser().parse_args(argv)
+
+
+def cmd_get_domain_presets(args: argparse.Namespace, config: "Config"):
     result: dict[str, list] = {}
 
     for preset_name, preset in config.config["preset"]["domain"].items():
@@ -209,11 +269,19 @@ def cmd_get_domain_presets(args: argparse.Namespace, config: Config):
     print(output.formatted(result, args.output_format))
 
 
-def cmd_get_config(args: argparse.Namespace, config: Config):
+def cmd_get_config(args: argparse.Namespace, config: "Config"):
     print(config.yaml)
 
 
-def cmd_create(args: argparse.Namespace, config: Config):
+def cmd_create(args: argparse.Namespace, config: "Config"):
+    # Heavy imports needed only when actually creating the VM.
+    import uuid
+
+    import libvirt  # type: ignore
+
+    from libvirt_instance.config import PresetNotFoundError
+    from libvirt_instance.domain import DomainDefinition, Volume
+
     instance_id = str(uuid.uuid4())
 
     cpu_model = args.cpu_model or config.get_defaults("cpu-model")
@@ -228,7 +296,13 @@ def cmd_create(args: argparse.Namespace, config: Config):
             "Please use --domain-preset to select a domain preset to base the VM on"
         )
 
-    domain_preset = config.get_preset("domain", domain_preset_name)
+    try:
+        domain_preset = config.get_preset("domain", domain_preset_name)
+    except PresetNotFoundError as e:
+        if args.domain_preset:
+            raise
+        # The name came from the config file defaults, not the command line.
+        raise CliError(str(e))
 
     machine_type = args.machine_type or domain_preset["machine-type"]
     arch_name = args.arch_name or domain_preset["arch-name"]
@@ -244,27 +318,12 @@ def cmd_create(args: argparse.Namespace, config: Config):
             disk["name"] = f"{args.name}-disk{i}"
             disk["size"] = disk_size
 
-            for key in (
-                "pool",
-                "bus",
-                "cache",
-                "source",
-                "source-pool",
-                "encryption-format",
-                "encryption-secret",
-                "encryption-cipher",
-                "encryption-ivgen",
-            ):
-                if key in kwargs:
-                    disk[key] = kwargs[key]
-
-            for key in ("boot-order",):
-                if key in kwargs:
-                    disk[key] = int(kwargs[key])
-
-            for key in ("exist-ok",):
-                if key in kwargs:
-                    disk[key] = kwargs[key].lower() == "true"
+            keys = kwargs.keys()
+            disk.update((key, kwargs[key]) for key in keys & DISK_STR_KEYS)
+            disk.update((key, int(kwargs[key])) for key in keys & DISK_INT_KEYS)
+            disk.update(
+                (key, kwargs[key].lower() == "true") for key in keys & DISK_BOOL_KEYS
+            )
 
             disks.append(disk)
 
@@ -275,19 +334,25 @@ def cmd_create(args: argparse.Namespace, config: Config):
 
             nic = preset.copy()
 
-            for key in ("model-type", "network", "bridge", "mac-address"):
-                if key in kwargs:
-                    nic[key] = kwargs[key]
+            keys = kwargs.keys()
+            nic.update((key, kwargs[key]) for key in keys & NIC_STR_KEYS)
+            nic.update((key, int(kwargs[key])) for key in keys & NIC_INT_KEYS)
 
-            for key in ("boot-order", "mtu"):
-                if key in kwargs:
-                    nic[key] = int(kwargs[key])
+            nic_type = nic["type"]
+            if nic_type not in nic:
+                raise CliError(
+                    f"Please provide {nic_type} for the network interface "
+                    f"based on the {preset_name} preset"
+                )
 
             nics.append((nic, kwargs))
 
     seed_disk: Optional[dict[str, Any]]
 
     if args.cloud_seed_disk is not None:
+        # Pulls in pycdlib, which is only needed to build the seed image.
+        from libvirt_instance import seed_image
+
         preset_name, kwargs = args.cloud_seed_disk
         preset = config.get_preset("disk", preset_name)
         preset_type = preset["type"]
@@ -310,22 +375,20 @@ def cmd_create(args: argparse.Namespace, config: Config):
             elif key in preset:
                 seed_disk[key] = preset[key]
 
-        meta_data = {
-            "instance-id": instance_id,
-            "local-hostname": args.cloud_hostname or args.name,
-        }
-        meta_data_body = yaml.dump(meta_data)
+        meta_data_body = seed_image.meta_data(
+            instance_id, args.cloud_hostname or args.name
+        )
 
+        # The files are copied into the image as is, no need to decode them.
         if args.cloud_user_data_file is not None:
-            with open(args.cloud_user_data_file, "r") as fp:
-                user_data_body = fp.read()
+            user_data_body = args.cloud_user_data_file.read_bytes()
         else:
             # user-data is not optional, simulate empty file if missing.
-            user_data_body = ""
+            user_data_body = b""
 
+        network_config_body: Optional[bytes]
         if args.cloud_network_config_file is not None:
-            with open(args.cloud_network_config_file, "r") as fp:
-                network_config_body = fp.read()
+            network_config_body = args.cloud_network_config_file.read_bytes()
         else:
             network_config_body = None  # network-config is optional.
 
@@ -336,120 +399,131 @@ def cmd_create(args: argparse.Namespace, config: Config):
     else:
         seed_disk = None
 
-    conn = libvirt.open(args.connect)
-
-    d = DomainDefinition(
-        args.name,
-        ram_bytes=args.memory,
-        vcpus=args.vcpu,
-        basexml=domain_preset["xml"],
-        libvirt_conn=conn,
-        domain_type=domain_type,
-        machine=machine_type,
-        uuid=instance_id,
-        arch_name=arch_name,
-        cpu_model=cpu_model,
-    )
+    with contextlib.closing(libvirt.open(args.connect)) as conn:
 
-    for disk in disks:
-        disk_type = disk["type"]
+        d = DomainDefinition(
+            args.name,
+            ram_bytes=args.memory,
+            vcpus=args.vcpu,
+            basexml=domain_preset["xml"],
+            libvirt_conn=conn,
+            domain_type=domain_type,
+            machine=machine_type,
+            uuid=instance_id,
+            arch_name=arch_name,
+            cpu_model=cpu_model,
+        )
+
+        for disk in disks:
+            disk_type = disk["type"]
+
+            if disk_type == "volume":
+                v = Volume(
+                    "{}{}".format(args.volume_name_prefix, disk["name"]),
+                    create_size_bytes=disk["size"],
+                    libvirt_conn=conn,
+                    pool_name=disk["pool"],
+                    source_name=disk.get("source", None),
+                    source_pool_name=disk.get("source-pool", None),
+                    encryption_format=disk.get("encryption-format", None),
+                    encryption_secret=disk.get("encryption-secret", None),
+                    encryption_cipher=(
+                        parse_cipher(disk["encryption-cipher"])
+                        if "encryption-cipher" in disk
+                        else None
+                    ),
+                    encryption_ivgen=(
+                        parse_ivgen(disk["encryption-ivgen"])
+                        if "encryption-ivgen" in disk
+                        else None
+                    ),
+                    exist_ok=disk.get("exist-ok", False),
+                )
+
+                d.add_disk(
+                    v,
+                    bus=disk["bus"],
+                    cache=disk["cache"],
+                    boot_order=disk.get("boot-order", None),
+                )
+            else:
+                raise CliError(f"Disk type {disk_type} is unsupported")
+
+        if seed_disk is not None:
 
-        if disk_type == "volume":
             v = Volume(
-                "{}{}".format(args.volume_name_prefix, disk["name"]),
-                create_size_bytes=disk["size"],
+                f"{args.volume_name_prefix}{args.name}-seed",
+                create_size_bytes=seed_disk["size"],
                 libvirt_conn=conn,
-                pool_name=disk["pool"],
-                source_name=disk.get("source", None),
-                source_pool_name=disk.get("source-pool", None),
-                encryption_format=disk.get("encryption-format", None),
-                encryption_secret=disk.get("encryption-secret", None),
-                encryption_cipher=(
-                    parse_cipher(disk["encryption-cipher"])
-                    if "encryption-cipher" in disk
-                    else None
-                ),
-                encryption_ivgen=(
-                    parse_ivgen(disk["encryption-ivgen"])
-                    if "encryption-ivgen" in disk
-                    else None
-                ),
-                exist_ok=disk.get("exist-ok", False),
+                pool_name=seed_disk["pool"],
             )
 
+            v.upload(seed_disk["fp"], seed_disk["size"])
+
             d.add_disk(
                 v,
-                bus=disk["bus"],
-                cache=disk["cache"],
-                boot_order=disk.get("boot-order", None),
+                bus=seed_disk["bus"],
+                cache=seed_disk["cache"],
             )
-        else:
-            raise CliError(f"Disk type {disk_type} is unsupported")
 
-    if seed_disk is not None:
-
-        v = Volume(
-            f"{args.volume_name_prefix}{args.name}-seed",
-            create_size_bytes=seed_disk["size"],
-            libvirt_conn=conn,
-            pool_name=seed_disk["pool"],
-        )
-
-        v.upload(seed_disk["fp"], seed_disk["size"])
-
-        d.add_disk(
-            v,
-            bus=seed_disk["bus"],
-            cache=seed_disk["cache"],
-        )
+        # Interface types are validated when the config is loaded.
+        add_interface: dict[str, Callable[..., None]] = {
+            "network": d.add_network_interface,
+            "bridge": d.add_bridge_interface,
+        }
 
-    for nic, kwargs in nics:
-        nic_type = nic["type"]
-        if nic_type == "network":
-            d.add_network_interface(
-                nic["network"],
-                model_type=nic["model-type"],
-                mac_address=nic.get("mac-address", None),
-                boot_order=nic.get("boot-order", None),
-                mtu=nic.get("mtu", None),
-            )
-        elif nic_type == "bridge":
-            d.add_bridge_interface(
-                nic["bridge"],
-                model_type=nic["model-type"],
+        for nic, kwargs in nics:
+            nic_type = nic["type"]
+            add_interface[nic_type](
+                nic[nic_type],
+                model_type=nic.get("model-type", "virtio"),
                 mac_address=nic.get("mac-address", None),
                 boot_order=nic.get("boot-order", None),
                 mtu=nic.get("mtu", None),
             )
-        else:
-            raise CliError(f"Network interface type {nic_type} is unsupported")
 
-    d.define()
+        d.define()
 
     print(output.formatted({"instance-id": instance_id}, args.output_format))
 
 
 def main() -> None:
+    # Plain "version" needs neither the argument parser nor the config.
+    if sys.argv[1:] == ["version"]:
+        print(package_version())
+        return
 
     args = parse_args()
 
-    logging.basicConfig(level=args.log_level)
+    logging.basicConfig(level=LOG_LEVELS[args.log_level])
 
-    if args.config_file.exists():
-        with open(args.config_file, "r") as f:
-            config = Config(f)
-    else:
-        config = Config()
+    # The config module pulls in yaml, which argument parsing doesn't need.
+    from libvirt_instance.config import Config, ConfigError, PresetNotFoundError
+
+    try:
+        if args.config_file.exists():
+            with open(args.config_file, "r") as f:
+                config = Config(f)
+        else:
+            config = Config()
+    except ConfigError as e:
+        # Problems in the config file are not usage errors.
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
 
     try:
         if args.command == "version":
-            print(importlib.metadata.version("libvirt-instance"))
+            print(package_version())
         elif args.command == "get-domain-presets":
             cmd_get_domain_presets(args, config)
         elif args.command == "get-config":
             cmd_get_config(args, config)
         elif args.command == "create":
             cmd_create(args, config)
-    except CliError as e:
+    except PresetNotFoundError as e:
+        # Presets are named on the command line, report unknown ones the
+        # same way argparse reports invalid arguments.
+        build_parser().error(str(e))
+    except (CliError, ConfigError) as e:
         print(str(e), file=sys.stderr)
         sys.exit(1)
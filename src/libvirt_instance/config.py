@@ -1,22 +1,42 @@
 # MIT license
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
-import copy
+import functools
 import importlib.resources
+from pathlib import Path
 from typing import Any, Optional, TextIO
 
 import yaml
 
+# Use the libyaml-backed loader and dumper when PyYAML was built with them.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
 
 class xml_str(str):
-    pass
+    __slots__ = ()
+
+
+class _bundled_xml(str):
+    """
+    Name of a domain XML file bundled with the package, read on first use.
+    """
+
+    __slots__ = ()
 
 
 def yaml_xml_str_representer(dumper, data):
-    return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|")
+    return dumper.represent_scalar("tag:yaml.org,2002:str", str(data), style="|")
+
 
+YamlDumper.add_representer(xml_str, yaml_xml_str_representer)
 
-yaml.representer.SafeRepresenter.add_representer(xml_str, yaml_xml_str_representer)
+
+REQUIRED_DOMAIN_KEYS = frozenset(("machine-type", "arch-name", "xml"))
+
+# Interface presets name their source under a key matching the type, which
+# may also be given on the command line.
+INTERFACE_TYPES = frozenset(("network", "bridge"))
 
 
 DEFAULT_CONFIG: dict[str, dict] = {
@@ -29,24 +49,12 @@ DEFAULT_CONFIG: dict[str, dict] = {
             "headless-server-x86_64": {
                 "arch-name": "x86_64",
                 "machine-type": "pc",
-                "xml": xml_str(
-                    (
-                        importlib.resources.files("libvirt_instance")
-                        / "domain-presets"
-                        / "headless-server-x86_64.xml"
-                    ).read_text()
-                ),
+                "xml": _bundled_xml("headless-server-x86_64.xml"),
             },
             "headless-server-aarch64": {
                 "arch-name": "aarch64",
                 "machine-type": "virt",
-                "xml": xml_str(
-                    (
-                        importlib.resources.files("libvirt_instance")
-                        / "domain-presets"
-                        / "headless-server-aarch64.xml"
-                    ).read_text()
-                ),
+                "xml": _bundled_xml("headless-server-aarch64.xml"),
             },
         },
         "disk": {},
@@ -55,6 +63,31 @@ DEFAULT_CONFIG: dict[str, dict] = {
 }
 
 
+@functools.cache
+def domain_preset_resources():
+    return importlib.resources.files("libvirt_instance") / "domain-presets"
+
+
+@functools.cache
+def read_domain_preset_resource(name: str) -> str:
+    return (domain_preset_resources() / name).read_text()
+
+
+def clone_config(config: dict[str, dict]) -> dict[str, dict]:
+    """
+    Copy a config deep enough for Config to modify it, but no deeper.
+    Preset values are scalars and are shared with the original.
+    """
+
+    return {
+        "defaults": dict(config["defaults"]),
+        "preset": {
+            preset_type: {name: dict(preset) for name, preset in presets.items()}
+            for preset_type, presets in config["preset"].items()
+        },
+    }
+
+
 class ConfigError(Exception):
     pass
 
@@ -72,64 +105,106 @@ class InvalidPresetError(ConfigError):
 
 
 class Config:
+    __slots__ = ("_config", "_preset_types", "_presets")
+
     def __init__(
         self,
         config_file_object: Optional[TextIO] = None,
         default_config: dict[str, dict] = DEFAULT_CONFIG,
     ) -> None:
-        self._config = copy.deepcopy(default_config)
+        self._config = clone_config(default_config)
 
         if config_file_object is not None:
-            user_config = yaml.safe_load(config_file_object)
+            data = config_file_object.read()
+
+            # Blank or comment-only files are not worth running the parser on.
+            if any(
+                line and not line.startswith("#")
+                for line in (raw_line.strip() for raw_line in data.splitlines())
+            ):
+                user_config = yaml.load(data, Loader=YamlLoader) or {}
+            else:
+                user_config = {}
 
             self._config["defaults"].update(user_config.get("defaults", {}))
 
+            user_config_presets = user_config.get("preset", {})
             for preset_type in ("domain", "disk", "interface"):
-                user_config_presets = user_config.get("preset", {}).get(preset_type, {})
-                for preset_name, preset in user_config_presets.items():
-                    self._config["preset"][preset_type][preset_name] = preset
+                presets = user_config_presets.get(preset_type)
+                if presets:
+                    self._config["preset"][preset_type].update(presets)
 
         # Validation and corrections
         for preset_name, preset in self._config["preset"]["domain"].items():
             if "xml-file" in preset:
-                with open(preset["xml-file"], "r") as fp:
-                    preset["xml"] = xml_str(fp.read())
-            # Wrap the XML into xml_str type for better formatting
-            # in self.yaml().
-            elif "xml" in preset:
-                s = preset["xml"]
-                preset["xml"] = xml_str(s)
-
-            for key in ("machine-type", "arch-name", "xml"):
-                if key not in preset:
-                    raise InvalidPresetError(
-                        f'Preset domain/{preset_name} is missing a value for "{key}"'
-                    )
+                preset["xml"] = Path(preset["xml-file"]).read_text()
+
+            missing_keys = REQUIRED_DOMAIN_KEYS.difference(preset)
+            if missing_keys:
+                missing = ", ".join(f'"{key}"' for key in sorted(missing_keys))
+                raise InvalidPresetError(
+                    f"Preset domain/{preset_name} is missing a value for {missing}"
+                )
+
+        for preset_name, preset in self._config["preset"].get("interface", {}).items():
+            interface_type = preset.get("type")
+            if interface_type not in INTERFACE_TYPES:
+                raise InvalidPresetError(
+                    f"Preset interface/{preset_name} has unsupported type {interface_type}"
+                )
 
         # TODO: More preset validation.
 
+        self._preset_types = frozenset(self._config["preset"])
+        self._presets = {
+            (preset_type, preset_name): preset
+            for preset_type, presets in self._config["preset"].items()
+            for preset_name, preset in presets.items()
+        }
+
     @property
     def config(self):
+        for preset in self._config["preset"]["domain"].values():
+            self._load_domain_xml(preset)
+
         return self._config
 
     @property
     def yaml(self):
-        return yaml.safe_dump(self._config, indent=2, sort_keys=True)
+        domain_presets = {}
+        for preset_name, preset in self.config["preset"]["domain"].items():
+            # Wrap the XML into xml_str type for better formatting.
+            domain_presets[preset_name] = {**preset, "xml": xml_str(preset["xml"])}
+
+        config = {
+            **self._config,
+            "preset": {**self._config["preset"], "domain": domain_presets},
+        }
+
+        return yaml.dump(config, Dumper=YamlDumper, indent=2, sort_keys=True)
 
     def get_defaults(self, key: str) -> Optional[str]:
         return self._config["defaults"].get(key, None)
 
     def get_preset(self, preset_type: str, preset_name: str) -> dict[str, Any]:
-        if preset_type not in self._config["preset"]:
+        if preset_type not in self._preset_types:
             raise UnsupportedPresetTypeError(
                 f"Preset type {preset_type} is not supported"
             )
 
         try:
-            preset = self._config["preset"][preset_type][preset_name]
+            preset = self._presets[(preset_type, preset_name)]
         except KeyError:
             raise PresetNotFoundError(
                 f"Preset {preset_type}/{preset_name} not found in the config"
             )
 
+        if preset_type == "domain":
+            self._load_domain_xml(preset)
+
         return preset
+
+    def _load_domain_xml(self, preset: dict[str, Any]) -> None:
+        xml = preset["xml"]
+        if isinstance(xml, _bundled_xml):
+            preset["xml"] = read_domain_preset_resource(xml)
@@ -1,30 +1,48 @@
 # MIT license
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
+import functools
 import logging
+import weakref
 import xml.etree.ElementTree as ET
-from typing import Any, BinaryIO, Optional
+from typing import BinaryIO, Callable, NamedTuple, Optional
 
 import libvirt  # type: ignore
 
-from libvirt_instance.util import index_to_drive_name
+from libvirt_instance.util import drive_name_to_index, index_to_drive_name
 
 logger = logging.getLogger(__name__)
 
 DISK_BUS_VIRTIO = "virtio"
 DISK_BUS_SCSI = "scsi"
 
-DISK_BUS_PROPERTIES: dict[str, Any] = {
-    DISK_BUS_VIRTIO: {
-        "dev_prefix": "vd",
-        "max_nr": 32,  # https://rwmj.wordpress.com/2010/12/22/whats-the-maximum-number-of-virtio-blk-disks/
-    },
-    DISK_BUS_SCSI: {
-        "dev_prefix": "sd",
-        "max_nr": 1024,  # Technically more than 1024, but https://rwmj.wordpress.com/2017/04/25/how-many-disks-can-you-add-to-a-virtual-linux-machine/
-    },
+
+class DiskBusProperties(NamedTuple):
+    dev_prefix: str
+    max_nr: int
+
+
+DISK_BUS_PROPERTIES: dict[str, DiskBusProperties] = {
+    DISK_BUS_VIRTIO: DiskBusProperties(
+        dev_prefix="vd",
+        max_nr=32,  # https://rwmj.wordpress.com/2010/12/22/whats-the-maximum-number-of-virtio-blk-disks/
+    ),
+    DISK_BUS_SCSI: DiskBusProperties(
+        dev_prefix="sd",
+        max_nr=1024,  # Technically more than 1024, but https://rwmj.wordpress.com/2017/04/25/how-many-disks-can-you-add-to-a-virtual-linux-machine/
+    ),
 }
 
+# Top-level domain elements always regenerated from the arguments.
+REPLACED_DOMAIN_TAGS = frozenset(("name", "memory", "currentMemory", "vcpu"))
+
+SCSI_TARGETS = 256
+SCSI_UNITS = 16384
+SCSI_UNITS_MASK = (1 << SCSI_UNITS) - 1
+HVM_GUEST_CAPS_PATH = "./guest[os_type='hvm']"
+SCSI_DISK_PATH = "./disk/target[@bus='scsi']/.."
+SCSI_CONTROLLER_PATH = "./controller[@type='scsi'][@model='virtio-scsi']"
+
 
 class InvalidBaseXmlError(Exception):
     pass
@@ -54,6 +72,29 @@ class SourceVolumeEncryptedButNoSecretError(Exception):
     pass
 
 
+# Parsed capabilities are only ever read, so one copy per connection is enough.
+_capabilities_cache: weakref.WeakKeyDictionary[libvirt.virConnect, ET.Element] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def connection_capabilities(conn: libvirt.virConnect) -> ET.Element:
+    if conn not in _capabilities_cache:
+        _capabilities_cache[conn] = ET.fromstring(conn.getCapabilities())
+
+    return _capabilities_cache[conn]
+
+
+# Emulator paths resolved from the capabilities, by (domain type, arch, machine).
+_emulator_cache: weakref.WeakKeyDictionary[
+    libvirt.virConnect, dict[tuple[str, str, str], str]
+] = weakref.WeakKeyDictionary()
+
+
+def read_upload_chunk(stream: libvirt.virStream, nbytes: int, fp: BinaryIO) -> bytes:
+    return fp.read(nbytes)
+
+
 class Volume:
     def __init__(
         self,
@@ -71,11 +112,9 @@ class Volume:
         encryption_ivgen: Optional[dict] = None,
     ) -> None:
 
-        alignment_remainder = create_size_bytes % (2**20)
-        if alignment_remainder == 0:
-            volume_size_bytes = create_size_bytes
-        else:
-            volume_size_bytes = create_size_bytes + (2**20 - alignment_remainder)
+        # Round up to the next 1MiB boundary.
+        volume_size_bytes = (create_size_bytes + 2**20 - 1) & ~(2**20 - 1)
+        if volume_size_bytes != create_size_bytes:
             logger.debug(
                 f"Padding target volume {name} size from requested {create_size_bytes} "
                 f"bytes to {volume_size_bytes} bytes for 1MiB alignment"
@@ -90,18 +129,25 @@ class Volume:
 
         self.pool = self._conn.storagePoolLookupByName(pool_name)
 
-        pool_el = ET.fromstring(self.pool.XMLDesc())
+        self.pool_el = ET.fromstring(self.pool.XMLDesc())
 
-        self.pool_type = pool_el.get("type")
+        self.pool_type = self.pool_el.get("type")
 
-        if name in set(self.pool.listVolumes()):
+        try:
+            existing_volume = self.pool.storageVolLookupByName(name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                raise
+            existing_volume = None
+
+        if existing_volume is not None:
             if not exist_ok:
                 raise VolumeAlreadyExistsError(
                     f"Volume {name} already exists in the {pool_name} pool."
                 )
 
             logger.debug(f"Using existing volume {name}")
-            self.volume = self.pool.storageVolLookupByName(name)
+            self.volume = existing_volume
         else:
             volume_el = ET.Element("volume")
 
@@ -110,39 +156,43 @@ class Volume:
             if source_name is None:
                 logger.debug(f"Creating a new volume {name} from scratch")
 
-                capacity_el = ET.SubElement(volume_el, "capacity")
-                capacity_el.set("unit", "bytes")
+                capacity_el = ET.SubElement(volume_el, "capacity", unit="bytes")
                 capacity_el.text = str(volume_size_bytes)
 
-                allocation_el = ET.SubElement(volume_el, "allocation")
-                allocation_el.set("unit", "bytes")
+                allocation_el = ET.SubElement(volume_el, "allocation", unit="bytes")
                 allocation_el.text = str(volume_size_bytes)
 
                 if self.encryption_secret is not None:
                     target_el = ET.SubElement(volume_el, "target")
 
-                    target_encryption_el = ET.SubElement(target_el, "encryption")
-                    target_encryption_el.set("format", self.encryption_format)
+                    target_encryption_el = ET.SubElement(
+                        target_el, "encryption", format=self.encryption_format
+                    )
 
-                    encryption_secret_el = ET.SubElement(target_encryption_el, "secret")
-                    encryption_secret_el.set("type", "passphrase")
-                    encryption_secret_el.set("uuid", self.encryption_secret)
+                    ET.SubElement(
+                        target_encryption_el,
+                        "secret",
+                        type="passphrase",
+                        uuid=self.encryption_secret,
+                    )
 
                     if encryption_cipher is not None:
-                        encryption_cipher_el = ET.SubElement(
-                            target_encryption_el, "cipher"
+                        ET.SubElement(
+                            target_encryption_el,
+                            "cipher",
+                            name=encryption_cipher["name"],
+                            size=str(encryption_cipher["size"]),
+                            mode=encryption_cipher["mode"],
+                            hash=encryption_cipher["hash"],
                         )
-                        encryption_cipher_el.set("name", encryption_cipher["name"])
-                        encryption_cipher_el.set("size", str(encryption_cipher["size"]))
-                        encryption_cipher_el.set("mode", encryption_cipher["mode"])
-                        encryption_cipher_el.set("hash", encryption_cipher["hash"])
 
                     if encryption_ivgen is not None:
-                        encryption_ivgen_el = ET.SubElement(
-                            target_encryption_el, "ivgen"
+                        ET.SubElement(
+                            target_encryption_el,
+                            "ivgen",
+                            name=encryption_ivgen["name"],
+                            hash=encryption_ivgen["hash"],
                         )
-                        encryption_ivgen_el.set("name", encryption_ivgen["name"])
-                        encryption_ivgen_el.set("hash", encryption_ivgen["hash"])
 
                 self.volume = self.pool.createXML(
                     ET.tostring(volume_el, encoding="unicode")
@@ -196,23 +246,93 @@ class Volume:
                         volume_size_bytes, libvirt.VIR_STORAGE_VOL_RESIZE_ALLOCATE
                     )
 
-    def upload(self, fp: BinaryIO, size: int) -> None:
-        def handler(stream: libvirt.virStream, nbytes: int, fp: BinaryIO):
-            logger.debug(f"Uploading chunk to volume {self.name}")
-            return fp.read(nbytes)
+    @functools.cached_property
+    def volume_el(self) -> ET.Element:
+        return ET.fromstring(self.volume.XMLDesc())
 
+    def upload(self, fp: BinaryIO, size: int) -> None:
         stream = self._conn.newStream()
 
         logger.debug(f"Starting upload of {size} bytes to volume {self.name}")
         self.volume.upload(stream, 0, size)
 
-        stream.sendAll(handler, fp)
+        stream.sendAll(read_upload_chunk, fp)
 
         stream.finish()
         logger.debug(f"Upload to volume {self.name} finished")
 
 
+def volume_disk_el(volume: Volume) -> ET.Element:
+    disk_el = ET.Element("disk", type="volume", device="disk")
+
+    ET.SubElement(
+        disk_el, "source", pool=volume.pool.name(), volume=volume.volume.name()
+    )
+
+    return disk_el
+
+
+def rbd_disk_el(volume: Volume) -> ET.Element:
+    disk_el = ET.Element("disk", type="network", device="disk")
+
+    pool_el = volume.pool_el
+
+    volume_path_el = volume.volume_el.find("./target/path")
+    if volume_path_el is not None:
+        path = volume_path_el.text
+    else:
+        path = None
+
+    if path is None:
+        raise RuntimeError("Volume {} is missing path".format(volume.volume.name()))
+
+    source_el = ET.SubElement(disk_el, "source", protocol="rbd", name=path)
+
+    for host_el in pool_el.findall("./source/host"):
+        name = host_el.get("name")
+        port = host_el.get("port")
+
+        if name is not None:
+            source_host_el = ET.SubElement(source_el, "host", name=name)
+            if port is not None:
+                source_host_el.set("port", port)
+
+    pool_source_auth_el = pool_el.find("./source/auth[@type='ceph']")
+    if pool_source_auth_el is not None:
+        auth_username = pool_source_auth_el.get("username")
+
+        pool_source_auth_secret_el = pool_source_auth_el.find("./secret")
+        if pool_source_auth_secret_el is not None:
+            auth_secret_uuid = pool_source_auth_secret_el.get("uuid")
+        else:
+            auth_secret_uuid = None
+
+        if auth_username and auth_secret_uuid:
+            auth_el = ET.SubElement(source_el, "auth", username=auth_username)
+            ET.SubElement(auth_el, "secret", type="ceph", uuid=auth_secret_uuid)
+
+    return disk_el
+
+
+# Disk element builders by storage pool type.
+DISK_EL_BUILDERS: dict[str, Callable[[Volume], ET.Element]] = {
+    "dir": volume_disk_el,
+    "logical": volume_disk_el,
+    "rbd": rbd_disk_el,
+}
+
+
 class DomainDefinition:
+    __slots__ = (
+        "_conn",
+        "_domain_el",
+        "_caps_el",
+        "_devices_el",
+        "_used_dev_nrs_by_bus",
+        "_used_scsi",
+        "_scsi_controllers",
+    )
+
     def __init__(
         self,
         name: str,
@@ -231,8 +351,7 @@ class DomainDefinition:
         self._conn = libvirt_conn
         self._domain_el = ET.fromstring(basexml)
 
-        caps = self._conn.getCapabilities()
-        self._caps_el = ET.fromstring(caps)
+        self._caps_el = connection_capabilities(self._conn)
 
         if self._domain_el.tag != "domain":
             raise InvalidBaseXmlError("The root of the base XML must be <domain>.")
@@ -262,44 +381,39 @@ class DomainDefinition:
         os_type_el = os_el.find("./type")
         if os_type_el is not None:
             os_el.remove(os_type_el)
-        os_type_el = ET.SubElement(os_el, "type")
-        os_type_el.set("arch", arch_name)
-        os_type_el.set("machine", machine)
+        os_type_el = ET.SubElement(os_el, "type", arch=arch_name, machine=machine)
         os_type_el.text = "hvm"
 
         cpu_el = self._domain_el.find("cpu")
 
         if cpu_model is None:
             if cpu_el is None:
-                cpu_el = ET.SubElement(self._domain_el, "cpu")
-                cpu_el.set("mode", "host-passthrough")
-                cpu_el.set("check", "none")
-                cpu_el.set("migratable", "on")
+                cpu_el = ET.SubElement(
+                    self._domain_el,
+                    "cpu",
+                    mode="host-passthrough",
+                    check="none",
+                    migratable="on",
+                )
         else:
             if cpu_el is not None:
                 self._domain_el.remove(cpu_el)
 
-            cpu_el = ET.SubElement(self._domain_el, "cpu")
-            cpu_el.set("mode", "custom")
-            cpu_el.set("match", "exact")
+            cpu_el = ET.SubElement(self._domain_el, "cpu", mode="custom", match="exact")
 
-            cpu_model_el = ET.SubElement(cpu_el, "model")
-            cpu_model_el.set("fallback", "allow")
+            cpu_model_el = ET.SubElement(cpu_el, "model", fallback="allow")
             cpu_model_el.text = cpu_model
 
-        for el_name in ("name", "memory", "currentMemory", "vcpu"):
-            el = self._domain_el.find(el_name)
-            if el is not None:
+        for el in list(self._domain_el):
+            if el.tag in REPLACED_DOMAIN_TAGS:
                 self._domain_el.remove(el)
 
         ET.SubElement(self._domain_el, "name").text = name
 
-        memory_el = ET.SubElement(self._domain_el, "memory")
-        memory_el.set("unit", "bytes")
+        memory_el = ET.SubElement(self._domain_el, "memory", unit="bytes")
         memory_el.text = str(ram_bytes)
 
-        vcpu_el = ET.SubElement(self._domain_el, "vcpu")
-        vcpu_el.set("placement", "static")
+        vcpu_el = ET.SubElement(self._domain_el, "vcpu", placement="static")
         vcpu_el.text = str(vcpus)
 
         devices_el = self._domain_el.find("./devices")
@@ -308,6 +422,11 @@ class DomainDefinition:
 
         self._devices_el = devices_el
 
+        # Collected on the first disk of each kind, then kept up to date by add_disk.
+        self._used_dev_nrs_by_bus: dict[str, set[int]] = {}
+        self._used_scsi: Optional[dict[tuple[int, int, int], int]] = None
+        self._scsi_controllers: Optional[list[int]] = None
+
         emulator_el = self._devices_el.find("./emulator")
         if emulator_el is None:
             emulator_el = ET.SubElement(self._devices_el, "emulator")
@@ -317,44 +436,45 @@ class DomainDefinition:
         return ET.tostring(self._domain_el, encoding="unicode")
 
     def _get_emulator(self, domain_type, arch_name, machine) -> str:
-        guest_caps_els = self._caps_el.findall("./guest")
+        emulators = _emulator_cache.setdefault(self._conn, {})
 
-        if guest_caps_els is None:
-            raise RuntimeError("No guest capabilities found.")
+        key = (domain_type, arch_name, machine)
+        if key not in emulators:
+            emulators[key] = self._find_emulator(domain_type, arch_name, machine)
 
-        for guest_caps_el in guest_caps_els:
-            os_type_el = guest_caps_el.find("./os_type")
-            if os_type_el is None:
-                continue
-            if os_type_el.text != "hvm":
-                continue
+        return emulators[key]
 
-            arch_els = guest_caps_el.findall(
-                f"./arch[@name='{arch_name}']/domain[@type='{domain_type}']/.."
-            )
-            if arch_els is None:
-                continue
+    def _find_emulator(self, domain_type, arch_name, machine) -> str:
+        for guest_caps_el in self._caps_el.iterfind(HVM_GUEST_CAPS_PATH):
+            for arch_el in guest_caps_el.iterfind("./arch"):
+                if arch_el.get("name") != arch_name:
+                    continue
 
-            for arch_el in arch_els:
-                domain_machine_el = arch_el.find(
-                    f"./domain[@type='{domain_type}']/machine[.='{machine}']"
+                domain_el = next(
+                    (
+                        el
+                        for el in arch_el.iterfind("./domain")
+                        if el.get("type") == domain_type
+                    ),
+                    None,
                 )
-                if domain_machine_el is None:
-                    machine_el = arch_el.find(f"./machine[.='{machine}']")
-                    if machine_el is None:
-                        continue
+                if domain_el is None:
+                    continue
 
-                domain_emulator_el = arch_el.find(
-                    f"./domain[@type='{domain_type}']/emulator"
-                )
-                if domain_emulator_el is not None:
-                    if domain_emulator_el.text is not None:
-                        return domain_emulator_el.text
+                # Machine types can be listed per domain type or for the whole arch.
+                if not any(
+                    machine_el.text == machine
+                    for parent_el in (domain_el, arch_el)
+                    for machine_el in parent_el.iterfind("./machine")
+                ):
+                    continue
+
+                emulator = domain_el.findtext("./emulator")
+                if not emulator:
+                    emulator = arch_el.findtext("./emulator")
 
-                arch_emulator_el = arch_el.find("./emulator")
-                if arch_emulator_el is not None:
-                    if arch_emulator_el.text is not None:
-                        return arch_emulator_el.text
+                if emulator:
+                    return emulator
 
                 raise RuntimeError("Found architecture is missing emulator")
 
@@ -377,10 +497,35 @@ class DomainDefinition:
     def define(self):
         self._conn.defineXML(str(self))
 
-    def _used_scsi_addresses(self) -> dict[int, dict[int, dict[int, set]]]:
-        used_addresses: dict[int, dict[int, dict[int, set]]] = {}
+    def _used_dev_nrs(self, bus: str, dev_prefix: str) -> set[int]:
+        used_dev_nrs = set()
+
+        for target_el in self._devices_el.findall(f"./disk/target[@bus='{bus}']"):
 
-        for disk_el in self._devices_el.findall("./disk/target[@bus='scsi']/.."):
+            target_dev = target_el.get("dev")
+            if target_dev is None:
+                continue
+
+            if not target_dev.startswith(dev_prefix):
+                continue
+
+            try:
+                used_dev_nrs.add(
+                    drive_name_to_index(target_dev.removeprefix(dev_prefix))
+                )
+            except ValueError:
+                continue
+
+        return used_dev_nrs
+
+    def _used_scsi_addresses(self) -> dict[tuple[int, int, int], int]:
+        """
+        Map (controller, bus, target) to a bit mask of the units in use.
+        """
+
+        used_addresses: dict[tuple[int, int, int], int] = {}
+
+        for disk_el in self._devices_el.findall(SCSI_DISK_PATH):
 
             address_el = disk_el.find("./address[@type='drive']")
             if address_el is None:
@@ -408,60 +553,63 @@ class DomainDefinition:
                 raise RuntimeError("SCSI disk address is missing a unit attribute")
             unit = int(unit_attr)
 
-            if controller not in used_addresses:
-                used_addresses[controller] = {}
-
-            if bus not in used_addresses[controller]:
-                used_addresses[controller][bus] = {}
-
-            if target not in used_addresses[controller][bus]:
-                used_addresses[controller][bus][target] = set()
-
-            used_addresses[controller][bus][target].add(unit)
+            # Units outside the range are never allocated, no need to track them.
+            if 0 <= unit < SCSI_UNITS:
+                key = (controller, bus, target)
+                used_addresses[key] = used_addresses.get(key, 0) | 1 << unit
 
         return used_addresses
 
     def _allocate_scsi_address(self) -> tuple[int, int, int, int]:
 
-        used_addresses = self._used_scsi_addresses()
+        if self._used_scsi is None:
+            self._used_scsi = self._used_scsi_addresses()
 
-        controller_els = self._devices_el.findall(
-            "./controller[@type='scsi'][@model='virtio-scsi']"
-        )
+        used_addresses = self._used_scsi
+
+        if self._scsi_controllers is None:
+            self._scsi_controllers = [
+                int(controller_el.get("index") or "0")
+                for controller_el in self._devices_el.findall(SCSI_CONTROLLER_PATH)
+            ]
+
+        scsi_controllers = self._scsi_controllers
 
         # bus is limited to a single 0
         bus = 0
 
-        for controller_el in controller_els:
-            index_attr = controller_el.get("index") or "0"
-            controller = int(index_attr)
-            for target in range(256):
-                for unit in range(16384):
-                    if unit not in used_addresses.get(controller, {}).get(bus, {}).get(
-                        target, set()
-                    ):
-                        break
-                else:
-                    continue
-
-                break
+        for controller in scsi_controllers:
+            for target in range(SCSI_TARGETS):
+                used_units = used_addresses.get((controller, bus, target), 0)
+                free_units = ~used_units & SCSI_UNITS_MASK
+                if free_units:
+                    # Position of the lowest set bit.
+                    unit = (free_units & -free_units).bit_length() - 1
+                    break
             else:
                 continue
 
             break
         else:  # No room found on existing controllers.
-            if len(controller_els) < 32:
-                controller = len(controller_els)
-                controller_el = ET.SubElement(self._devices_el, "controller")
-                controller_el.set("type", "scsi")
-                controller_el.set("model", "virtio-scsi")
-                controller_el.set("index", str(controller))
+            if len(scsi_controllers) < 32:
+                controller = len(scsi_controllers)
+                ET.SubElement(
+                    self._devices_el,
+                    "controller",
+                    type="scsi",
+                    model="virtio-scsi",
+                    index=str(controller),
+                )
+                scsi_controllers.append(controller)
                 target = 0
                 unit = 0
             else:
                 # 256 * 16384 = 4194304, yeah, right :)
                 raise RuntimeError("All available SCSI controllers are full.")
 
+        key = (controller, bus, target)
+        used_addresses[key] = used_addresses.get(key, 0) | 1 << unit
+
         return controller, bus, target, unit
 
     # TODO: Function too long, needs refactor.
@@ -475,115 +623,41 @@ class DomainDefinition:
         boot_order: Optional[int] = None,
     ) -> None:
 
-        try:
-            bus_type_properties = DISK_BUS_PROPERTIES[bus]
-        except KeyError:
+        bus_type_properties = DISK_BUS_PROPERTIES.get(bus)
+        if bus_type_properties is None:
             raise UnsupportedBusError(f"Unsupported bus {bus}")
 
-        disk_el = ET.Element("disk")
-
-        if volume.pool_type in ("dir", "logical"):
-            disk_el.set("type", "volume")
-            disk_el.set("device", "disk")
-
-            source_el = ET.SubElement(disk_el, "source")
-            source_el.set("pool", volume.pool.name())
-            source_el.set("volume", volume.volume.name())
-        elif volume.pool_type == "rbd":
-            disk_el.set("type", "network")
-            disk_el.set("device", "disk")
-
-            pool_el = ET.fromstring(volume.pool.XMLDesc())
-            volume_el = ET.fromstring(volume.volume.XMLDesc())
-
-            volume_path_el = volume_el.find("./target/path")
-            if volume_path_el is not None:
-                path = volume_path_el.text
-            else:
-                path = None
-
-            if path is None:
-                raise RuntimeError(
-                    "Volume {} is missing path".format(volume.volume.name())
-                )
-
-            source_el = ET.SubElement(disk_el, "source")
-            source_el.set("protocol", "rbd")
-            source_el.set("name", path)
-
-            for host_el in pool_el.findall("./source/host"):
-                name = host_el.get("name")
-                port = host_el.get("port")
-
-                if name is not None:
-                    source_host_el = ET.SubElement(source_el, "host")
-                    source_host_el.set("name", name)
-                    if port is not None:
-                        source_host_el.set("port", port)
-
-            pool_source_auth_el = pool_el.find("./source/auth[@type='ceph']")
-            if pool_source_auth_el is not None:
-                auth_username = pool_source_auth_el.get("username")
-
-                pool_source_auth_secret_el = pool_source_auth_el.find("./secret")
-                if pool_source_auth_secret_el is not None:
-                    auth_secret_uuid = pool_source_auth_secret_el.get("uuid")
-                else:
-                    auth_secret_uuid = None
-
-                if auth_username and auth_secret_uuid:
-                    auth_el = ET.SubElement(source_el, "auth")
-                    auth_el.set("username", auth_username)
-                    auth_secret_el = ET.SubElement(auth_el, "secret")
-                    auth_secret_el.set("type", "ceph")
-                    auth_secret_el.set("uuid", auth_secret_uuid)
-
-        else:
+        disk_el_builder = DISK_EL_BUILDERS.get(volume.pool_type or "")
+        if disk_el_builder is None:
             raise UnsupportedVolumeTypeError()
 
-        dev_prefix = bus_type_properties["dev_prefix"]
-        max_nr = bus_type_properties["max_nr"]
-
-        existing_target_devices = []
-
-        for target_el in self._devices_el.findall(f"./disk/target[@bus='{bus}']"):
-
-            target_dev = target_el.get("dev")
-            if target_dev is None:
-                continue
+        disk_el = disk_el_builder(volume)
 
-            if not target_dev.startswith(dev_prefix):
-                continue
-
-            existing_target_devices.append(target_dev)
+        dev_prefix, max_nr = bus_type_properties
 
-        for dev_nr in range(max_nr):
-            drive_name = index_to_drive_name(dev_nr)
-            dev = f"{dev_prefix}{drive_name}"
+        if bus not in self._used_dev_nrs_by_bus:
+            self._used_dev_nrs_by_bus[bus] = self._used_dev_nrs(bus, dev_prefix)
 
-            if dev in existing_target_devices:
-                continue
+        used_dev_nrs = self._used_dev_nrs_by_bus[bus]
 
-            break
-        else:
+        dev_nr = next((nr for nr in range(max_nr) if nr not in used_dev_nrs), None)
+        if dev_nr is None:
             raise RuntimeError(
                 f"All of {max_nr} possible disk devices are already used on the {bus} bus."
             )
 
-        target_el = ET.SubElement(disk_el, "target")
-        target_el.set("dev", dev)
-        target_el.set("bus", bus)
+        dev = f"{dev_prefix}{index_to_drive_name(dev_nr)}"
 
-        driver_el = ET.SubElement(disk_el, "driver")
-        driver_el.set("name", "qemu")
-        driver_el.set("type", "raw")
-        driver_el.set("cache", cache)
+        ET.SubElement(disk_el, "target", dev=dev, bus=bus)
+
+        driver_el = ET.SubElement(
+            disk_el, "driver", name="qemu", type="raw", cache=cache
+        )
         if discard is not None:
             driver_el.set("discard", discard)
 
         if boot_order is not None:
-            boot_el = ET.SubElement(disk_el, "boot")
-            boot_el.set("order", str(boot_order))
+            ET.SubElement(disk_el, "boot", order=str(boot_order))
 
         if bus == DISK_BUS_SCSI:
             (
@@ -592,24 +666,32 @@ class DomainDefinition:
                 scsi_target,
                 scsi_unit,
             ) = self._allocate_scsi_address()
-            address_el = ET.SubElement(disk_el, "address")
-            address_el.set("type", "drive")
-            address_el.set("controller", str(scsi_controller))
-            address_el.set("bus", str(scsi_bus))
-            address_el.set("target", str(scsi_target))
-            address_el.set("unit", str(scsi_unit))
+            ET.SubElement(
+                disk_el,
+                "address",
+                type="drive",
+                controller=str(scsi_controller),
+                bus=str(scsi_bus),
+                target=str(scsi_target),
+                unit=str(scsi_unit),
+            )
 
         if volume.encryption_secret is not None:
-            encryption_el = ET.SubElement(disk_el, "encryption")
-            encryption_el.set("format", volume.encryption_format)
+            encryption_el = ET.SubElement(
+                disk_el, "encryption", format=volume.encryption_format
+            )
 
-            encryption_secret_el = ET.SubElement(encryption_el, "secret")
-            encryption_secret_el.set("type", "passphrase")
-            encryption_secret_el.set("uuid", volume.encryption_secret)
+            ET.SubElement(
+                encryption_el,
+                "secret",
+                type="passphrase",
+                uuid=volume.encryption_secret,
+            )
 
         # TODO: Autogenerate disk serial numbers?
 
         self._devices_el.append(disk_el)
+        used_dev_nrs.add(dev_nr)
 
     def _add_generic_interface(
         self,
@@ -621,20 +703,16 @@ class DomainDefinition:
     ) -> ET.Element:
         interface_el = ET.SubElement(self._devices_el, "interface")
 
-        model_el = ET.SubElement(interface_el, "model")
-        model_el.set("type", model_type)
+        ET.SubElement(interface_el, "model", type=model_type)
 
         if mtu is not None:
-            mtu_el = ET.SubElement(interface_el, "mtu")
-            mtu_el.set("size", str(mtu))
+            ET.SubElement(interface_el, "mtu", size=str(mtu))
 
         if mac_address is not None:
-            mac_el = ET.SubElement(interface_el, "mac")
-            mac_el.set("address", mac_address)
+            ET.SubElement(interface_el, "mac", address=mac_address)
 
         if boot_order is not None:
-            boot_el = ET.SubElement(interface_el, "boot")
-            boot_el.set("order", str(boot_order))
+            ET.SubElement(interface_el, "boot", order=str(boot_order))
 
         return interface_el
 
@@ -644,8 +722,7 @@ class DomainDefinition:
 
         interface_el.set("type", "bridge")
 
-        source_el = ET.SubElement(interface_el, "source")
-        source_el.set("bridge", source_bridge)
+        ET.SubElement(interface_el, "source", bridge=source_bridge)
 
     def add_network_interface(
         self,
@@ -657,5 +734,4 @@ class DomainDefinition:
 
         interface_el.set("type", "network")
 
-        source_el = ET.SubElement(interface_el, "source")
-        source_el.set("network", source_network)
+        ET.SubElement(interface_el, "source", network=source_network)
@@ -1,10 +1,19 @@
 # MIT license
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
+import functools
 import json
-from typing import Mapping, Union
+from typing import Callable, Mapping, Union
 
+FORMATTERS: dict[str, Callable[[Mapping], str]] = {
+    "json": functools.partial(json.dumps, indent=2, sort_keys=True),
+}
 
-def formatted(data: Mapping[str, Union[str, list]], format: str):
-    if format == "json":
-        return json.dumps(data, indent=2, sort_keys=True)
+
+def formatted(data: Mapping[str, Union[str, list]], format: str) -> str:
+    try:
+        formatter = FORMATTERS[format]
+    except KeyError:
+        raise ValueError(f"Unsupported output format {format}")
+
+    return formatter(data)
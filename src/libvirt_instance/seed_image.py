@@ -3,14 +3,26 @@
 
 # See https://cloudinit.readthedocs.io/en/latest/topics/datasources/nocloud.html
 
-from io import BytesIO
+import json
+from io import SEEK_END, BytesIO
 from typing import BinaryIO, Optional
 
 import pycdlib
 
 
+def meta_data(instance_id: str, local_hostname: str) -> bytes:
+    # Fixed two-key document; a JSON string is a valid YAML scalar and
+    # takes care of quoting whatever the hostname contains.
+    return (
+        f"instance-id: {instance_id}\n"
+        f"local-hostname: {json.dumps(local_hostname, ensure_ascii=False)}\n"
+    ).encode("utf-8")
+
+
 def build(
-    meta_data_body: str, user_data_body: str, network_config_body: Optional[str] = None
+    meta_data_body: bytes,
+    user_data_body: bytes,
+    network_config_body: Optional[bytes] = None,
 ) -> tuple[BinaryIO, int]:
     iso_fp = BytesIO()
 
@@ -18,7 +30,7 @@ def build(
     iso.new(vol_ident="cidata", joliet=3, rock_ridge="1.09")
 
     iso.add_fp(
-        BytesIO(meta_data_body.encode("utf-8")),
+        BytesIO(meta_data_body),
         len(meta_data_body),
         "/METADATA.;1",
         joliet_path="/meta-data",
@@ -26,7 +38,7 @@ def build(
     )
 
     iso.add_fp(
-        BytesIO(user_data_body.encode("utf-8")),
+        BytesIO(user_data_body),
         len(user_data_body),
         "/USERDATA.;1",
         joliet_path="/user-data",
@@ -35,7 +47,7 @@ def build(
 
     if network_config_body is not None:
         iso.add_fp(
-            BytesIO(network_config_body.encode("utf-8")),
+            BytesIO(network_config_body),
             len(network_config_body),
             "/NETWORK.;1",
             joliet_path="/network-config",
@@ -46,7 +58,8 @@ def build(
 
     iso.close()
 
-    size = len(iso_fp.getvalue())
+    # pycdlib may leave the position anywhere, seek() to the end returns the size.
+    size = iso_fp.seek(0, SEEK_END)
 
     iso_fp.seek(0)
 
@@ -4,6 +4,8 @@
 import re
 from string import ascii_lowercase
 
+SIZE_REGEX = re.compile(r"(\d+)\s*([iA-Z]{1,3})?")
+
 SIZE_UNITS = {
     None: 1,
     "B": 1,
@@ -26,16 +28,34 @@ def index_to_drive_name(idx: int) -> str:
     Convert decimal to bijective base-26
     """
 
-    coll = []
+    coll = bytearray()
     d = idx + 1
 
     while d:
-        d -= 1
-        r = d % 26
-        coll.append(ascii_lowercase[r])
-        d //= 26
+        d, r = divmod(d - 1, 26)
+        coll.append(ord("a") + r)
+
+    coll.reverse()
+
+    return coll.decode("ascii")
 
-    return "".join(reversed(coll))
+
+def drive_name_to_index(name: str) -> int:
+    """
+    Convert bijective base-26 to decimal
+    """
+
+    if not name:
+        raise ValueError("Empty drive name")
+
+    d = 0
+
+    for c in name:
+        if c not in ascii_lowercase:
+            raise ValueError(f"Invalid drive name {name}")
+        d = d * 26 + ascii_lowercase.index(c) + 1
+
+    return d - 1
 
 
 def human_size_units_to_bytes(size: str):
@@ -43,16 +63,18 @@ def human_size_units_to_bytes(size: str):
     Convert human-readable data size units into bytes.
     """
 
-    regex = r"^(?P<number>\d+)\s*(?P<unit>[iA-Z]{1,3})?$"
+    # Plain byte counts are the common case.
+    if size.isdecimal():
+        return int(size)
 
-    m = re.match(regex, size)
+    m = SIZE_REGEX.fullmatch(size)
     if m:
-        number = int(m.group("number"))
-        unit = m.group("unit")
+        number, unit = m.groups()
     else:
         raise ValueError(f"Invalid value {size}")
 
-    try:
-        return number * SIZE_UNITS[unit]
-    except KeyError:
+    multiplier = SIZE_UNITS.get(unit)
+    if multiplier is None:
         raise ValueError(f"Unit {unit} is not supported")
+
+    return int(number) * multiplier
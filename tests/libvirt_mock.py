@@ -3,21 +3,22 @@
 
 import copy
 import xml.etree.ElementTree as ET
+from typing import Optional
 
 import libvirt  # type: ignore
 
 
 class libvirtError(libvirt.libvirtError):
-    def __init__(self, msg: str):
+    def __init__(self, msg: str, code: Optional[int] = None):
 
         Exception.__init__(self, msg)
 
-        self.err = None
+        self.err = None if code is None else (code,)
 
 
 class virStorageVol(object):
-    def __init__(self, *args, _xml, _pool, **kwargs):
-        self._xml_el = ET.fromstring(_xml)
+    def __init__(self, *args, _pool, _xml=None, _xml_el=None, **kwargs):
+        self._xml_el = ET.fromstring(_xml) if _xml_el is None else _xml_el
 
         target_el = ET.Element("target")
         target_path_el = ET.SubElement(target_el, "path")
@@ -67,12 +68,14 @@ class virStoragePool:
     def name(self):
         return self._xml_el.find("./name").text
 
-    def createXML(self, xmlDesc, flags=0):
-        volume = virStorageVol(_xml=xmlDesc, _pool=self)
+    def _add_volume(self, volume):
         self._volumes[volume.name()] = volume
 
         return volume
 
+    def createXML(self, xmlDesc, flags=0):
+        return self._add_volume(virStorageVol(_xml=xmlDesc, _pool=self))
+
     def createXMLFrom(self, xmlDesc, clonevol, flags=0):
         volume_el = copy.deepcopy(clonevol._xml_el)
         name = ET.fromstring(xmlDesc).find("./name").text
@@ -82,13 +85,15 @@ class virStoragePool:
 
         volume_el.find("./name").text = name
 
-        return self.createXML(ET.tostring(volume_el, encoding="unicode"))
+        return self._add_volume(virStorageVol(_xml_el=volume_el, _pool=self))
 
     def storageVolLookupByName(self, name):
         try:
             return self._volumes[name]
         except KeyError:
-            raise libvirtError(f"Volume {name} does not exist.")
+            raise libvirtError(
+                f"Volume {name} does not exist.", libvirt.VIR_ERR_NO_STORAGE_VOL
+            )
 
 
 class virDomain(object):
@@ -1,6 +1,9 @@
 # MIT license
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
+import logging
+import sys
+
 import pytest
 
 from libvirt_instance import cli
@@ -26,6 +29,14 @@ def test_parse_spec_args_and_kwargs():
     assert cli.parse_spec("arg1,arg2,key=value") == (["arg1", "arg2"], {"key": "value"})
 
 
+def test_parse_spec_value_with_equals():
+    assert cli.parse_spec("arg1,key=a=b") == (["arg1"], {"key": "a=b"})
+
+
+def test_parse_spec_empty_items():
+    assert cli.parse_spec("arg1,,=value") == (["arg1", ""], {"": "value"})
+
+
 def test_parse_disk_spec():
     assert cli.parse_disk_spec("test,1MiB,key=value") == (
         "test",
@@ -59,3 +70,115 @@ def test_parse_cipher():
 
 def test_parse_ivgen():
     assert cli.parse_ivgen("essiv-sha256") == {"name": "essiv", "hash": "sha256"}
+
+
+def test_build_parser_cached():
+    assert cli.build_parser() is cli.build_parser()
+
+
+def test_log_levels():
+    assert cli.LOG_LEVELS["DEBUG"] == logging.DEBUG
+    assert cli.LOG_LEVELS["NOTSET"] == logging.NOTSET
+
+
+def test_parse_args_create():
+    args = cli.parse_args(
+        ["create", "test", "--memory", "1GiB", "--vcpu", "2", "--disk", "os,10GiB"]
+    )
+
+    assert args.command == "create"
+    assert args.name == "test"
+    assert args.memory == 1073741824
+    assert args.vcpu == 2
+    assert args.disk == [("os", 10737418240, {})]
+
+
+def test_main_unknown_preset(monkeypatch, capsys):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "libvirt-instance",
+            "--config-file",
+            "/nonexistent",
+            "create",
+            "test",
+            "--memory",
+            "1GiB",
+            "--vcpu",
+            "1",
+            "--domain-preset",
+            "DOES-NOT-EXIST",
+        ],
+    )
+
+    with pytest.raises(SystemExit) as e:
+        cli.main()
+
+    assert e.value.code == 2
+    assert "Preset domain/DOES-NOT-EXIST not found" in capsys.readouterr().err
+
+
+def test_main_nic_missing_source(monkeypatch, capsys, tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        """---
+preset:
+  interface:
+    lan:
+      type: network
+"""
+    )
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "libvirt-instance",
+            "--config-file",
+            str(config_file),
+            "create",
+            "test",
+            "--memory",
+            "1GiB",
+            "--vcpu",
+            "1",
+            "--domain-preset",
+            "headless-server-x86_64",
+            "--nic",
+            "lan,model-type=virtio",
+        ],
+    )
+
+    with pytest.raises(SystemExit) as e:
+        cli.main()
+
+    assert e.value.code == 1
+    assert "Please provide network" in capsys.readouterr().err
+
+
+def test_main_invalid_config_file(monkeypatch, capsys, tmp_path):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        """---
+preset:
+  interface:
+    lan:
+      type: direct
+"""
+    )
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["libvirt-instance", "--config-file", str(config_file), "get-config"],
+    )
+
+    with pytest.raises(SystemExit) as e:
+        cli.main()
+
+    assert e.value.code == 1
+
+    err = capsys.readouterr().err
+    assert "Preset interface/lan has unsupported type direct" in err
+    assert "usage:" not in err
@@ -6,6 +6,7 @@ from io import StringIO
 from pathlib import Path
 
 import pytest
+import yaml
 
 from libvirt_instance import config
 
@@ -16,6 +17,47 @@ def test_default_config():
     assert len(c.get_preset("domain", "headless-server-x86_64")["xml"]) > 0
 
 
+def test_default_config_dict():
+    c = config.Config(StringIO(""))
+
+    for preset in c.config["preset"]["domain"].values():
+        assert preset["xml"].startswith("<domain")
+
+
+def test_default_config_yaml():
+    presets = yaml.safe_load(config.Config().yaml)["preset"]["domain"]
+
+    for preset in presets.values():
+        assert set(preset) == {"arch-name", "machine-type", "xml"}
+        assert preset["xml"].startswith("<domain")
+
+
+def test_default_config_not_modified():
+    f = StringIO(
+        """---
+defaults:
+  domain-type: qemu
+preset:
+  disk:
+    test:
+      pool: default
+"""
+    )
+    default_xml = config.DEFAULT_CONFIG["preset"]["domain"]["headless-server-x86_64"][
+        "xml"
+    ]
+
+    c = config.Config(f)
+    c.get_preset("domain", "headless-server-x86_64")
+
+    assert config.DEFAULT_CONFIG["defaults"]["domain-type"] == "kvm"
+    assert config.DEFAULT_CONFIG["preset"]["disk"] == {}
+    assert (
+        config.DEFAULT_CONFIG["preset"]["domain"]["headless-server-x86_64"]["xml"]
+        is default_xml
+    )
+
+
 def test_yaml_config():
     f = StringIO(
         """---
@@ -37,6 +79,19 @@ preset:
     assert c.get_preset("domain", "empty")["xml"] == "<domain></domain>"
 
 
+@pytest.mark.parametrize("body", ["", "  \n\n", "# comment\n  # another\n", "---\n"])
+def test_empty_config(body):
+    c = config.Config(StringIO(body))
+
+    assert c.get_defaults("domain-type") == "kvm"
+
+
+def test_preset_xml_is_plain_str():
+    c = config.Config()
+
+    assert type(c.get_preset("domain", "headless-server-x86_64")["xml"]) is str
+
+
 def test_builtin_setting_override():
     f = StringIO(
         """---
@@ -107,6 +162,46 @@ preset:
         config.Config(f)
 
 
+def test_invalid_preset_reports_all_missing_keys():
+    f = StringIO(
+        """---
+preset:
+  domain:
+    test:
+      arch-name: x86_64
+"""
+    )
+    with pytest.raises(config.InvalidPresetError, match='"machine-type", "xml"$'):
+        config.Config(f)
+
+
+def test_invalid_interface_preset():
+    f = StringIO(
+        """---
+preset:
+  interface:
+    test:
+      type: direct
+"""
+    )
+    with pytest.raises(config.InvalidPresetError):
+        config.Config(f)
+
+
+def test_interface_preset_optional_keys():
+    f = StringIO(
+        """---
+preset:
+  interface:
+    test:
+      type: network
+"""
+    )
+    c = config.Config(f)
+
+    assert c.get_preset("interface", "test") == {"type": "network"}
+
+
 def test_config_yaml():
     f = StringIO(
         """---
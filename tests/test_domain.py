@@ -2,13 +2,15 @@
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
 import xml.etree.ElementTree as ET
+from io import BytesIO
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 
 import pytest
 
 from libvirt_instance import domain
 
-from .libvirt_mock import virConnect
+from .libvirt_mock import libvirtError, virConnect
 
 
 def test_volume():
@@ -92,6 +94,21 @@ def test_volume_existing_ok():
     assert v.volume.name() == "testvolume"
 
 
+def test_volume_lookup_error():
+    conn = virConnect()
+    pool = conn.storagePoolLookupByName("default")
+    pool.storageVolLookupByName = MagicMock(side_effect=libvirtError("Boom"))
+    conn.storagePoolLookupByName = MagicMock(return_value=pool)
+
+    with pytest.raises(libvirtError):
+        domain.Volume(
+            "testvolume",
+            create_size_bytes=16777216,
+            libvirt_conn=conn,
+            pool_name="default",
+        )
+
+
 def test_volume_from_source():
     conn = virConnect()
 
@@ -206,6 +223,43 @@ def test_volume_cipher():
     assert ivgen_el.get("hash") == "sha256"
 
 
+def test_volume_el_cached():
+    v = domain.Volume(
+        "testvolume",
+        create_size_bytes=16777216,
+        libvirt_conn=virConnect(),
+        pool_name="default",
+    )
+
+    assert v.volume_el is v.volume_el
+    assert int(v.volume_el.find("./capacity").text) == 16777216
+
+
+def test_volume_upload():
+    conn = virConnect()
+
+    v = domain.Volume(
+        "testvolume",
+        create_size_bytes=16777216,
+        libvirt_conn=conn,
+        pool_name="default",
+    )
+    v.volume = MagicMock()
+
+    chunks = []
+    stream = MagicMock()
+    stream.sendAll.side_effect = lambda handler, fp: chunks.extend(
+        iter(lambda: handler(stream, 4, fp), b"")
+    )
+    conn.newStream = MagicMock(return_value=stream)
+
+    v.upload(BytesIO(b"0123456789"), 10)
+
+    v.volume.upload.assert_called_once_with(stream, 0, 10)
+    stream.finish.assert_called_once()
+    assert chunks == [b"0123", b"4567", b"89"]
+
+
 def test_domain_init():
     domainxml = """
     <domain>
@@ -243,6 +297,23 @@ def test_domain_init():
     assert devices_emulator_el.text == "/usr/bin/qemu-kvm"
 
 
+def test_domain_init_capabilities_cached():
+    conn = virConnect()
+    conn.getCapabilities = MagicMock(wraps=conn.getCapabilities)
+
+    for name in ("foo", "bar"):
+        domain.DomainDefinition(
+            name,
+            ram_bytes=16777216,
+            vcpus=1,
+            libvirt_conn=conn,
+            basexml="<domain></domain>",
+            arch_name="x86_64",
+        )
+
+    conn.getCapabilities.assert_called_once()
+
+
 def test_domain_existing_devices():
     domainxml = """
     <domain>
@@ -708,6 +779,58 @@ def test_domain_add_disk_virtio_scsi_existing_controller():
     assert address_el.get("unit") == "0"
 
 
+def test_domain_add_disk_virtio_scsi_unit_gap():
+    domainxml = """
+    <domain>
+      <devices>
+        <controller type="scsi" model="virtio-scsi" index='0'/>
+        <disk type='volume' device='disk'>
+          <target dev='sda' bus='scsi'/>
+          <address type='drive' controller='0' bus='0' target='0' unit='0'/>
+        </disk>
+        <disk type='volume' device='disk'>
+          <target dev='sdb' bus='scsi'/>
+          <address type='drive' controller='0' bus='0' target='0' unit='1'/>
+        </disk>
+        <disk type='volume' device='disk'>
+          <target dev='sdd' bus='scsi'/>
+          <address type='drive' controller='0' bus='0' target='0' unit='3'/>
+        </disk>
+      </devices>
+    </domain>
+    """
+
+    conn = virConnect()
+
+    d = domain.DomainDefinition(
+        "foo",
+        ram_bytes=16777216,
+        vcpus=1,
+        libvirt_conn=conn,
+        basexml=domainxml,
+    )
+
+    v = domain.Volume(
+        "testvolume",
+        create_size_bytes=16777216,
+        libvirt_conn=conn,
+        pool_name="default",
+    )
+
+    d.add_disk(v, bus="scsi", cache="none")
+
+    domain_el = ET.fromstring(str(d))
+
+    disk_el = domain_el.find("./devices/disk[last()]")
+
+    assert disk_el.find("./target").get("dev") == "sdc"
+
+    address_el = disk_el.find("./address")
+    assert address_el.get("controller") == "0"
+    assert address_el.get("target") == "0"
+    assert address_el.get("unit") == "2"
+
+
 def test_domain_add_disk_multiple():
     domainxml = "<domain></domain>"
 
@@ -933,8 +1056,7 @@ def test_domain_add_disk_unsupported_volume_type():
         basexml=domainxml,
     )
 
-    v = MagicMock()
-    v.pool_type = "UNSUPPORTED"
+    v = SimpleNamespace(pool_type="UNSUPPORTED")
 
     with pytest.raises(domain.UnsupportedVolumeTypeError):
         d.add_disk(v)
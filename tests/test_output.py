@@ -1,6 +1,8 @@
 # MIT license
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
+import pytest
+
 from libvirt_instance import output
 
 
@@ -14,3 +16,8 @@ def test_json_format():
   "foo": "test"
 }"""
     )
+
+
+def test_unsupported_format():
+    with pytest.raises(ValueError):
+        output.formatted({"foo": "test"}, "xml")
@@ -4,12 +4,40 @@
 from io import BytesIO
 
 import pycdlib
+import pytest
+import yaml
 
 from libvirt_instance import seed_image
 
 
+@pytest.mark.parametrize(
+    "hostname",
+    [
+        "test",
+        "with: colon",
+        "# hash",
+        "- dash",
+        "'quoted\"",
+        "yes",
+        "\u00e4",
+        "\U0001f600",
+    ],
+)
+def test_meta_data(hostname):
+    body = seed_image.meta_data("a009bdf8-a172-4d63-9164-625b77f40ac4", hostname)
+
+    assert yaml.safe_load(body) == {
+        "instance-id": "a009bdf8-a172-4d63-9164-625b77f40ac4",
+        "local-hostname": hostname,
+    }
+    assert b"\\u" not in body
+
+
 def test_build():
-    iso_fp, size = seed_image.build("instance-id: foo", "#cloud-config")
+    iso_fp, size = seed_image.build(b"instance-id: foo", b"#cloud-config")
+
+    assert iso_fp.tell() == 0
+    assert size == len(iso_fp.getvalue())
 
     iso = pycdlib.PyCdlib()
 
@@ -36,7 +64,7 @@ def test_build():
 
 
 def test_build_with_network_config():
-    iso_fp, size = seed_image.build("instance-id: foo", "#cloud-config", "---")
+    iso_fp, size = seed_image.build(b"instance-id: foo", b"#cloud-config", b"---")
 
     iso = pycdlib.PyCdlib()
 
@@ -53,3 +81,18 @@ def test_build_with_network_config():
     iso.get_file_from_iso_fp(file_data, joliet_path="/network-config")
 
     assert file_data.getvalue().decode("utf-8") == "---"
+
+
+def test_build_multibyte_user_data():
+    iso_fp, size = seed_image.build(
+        b"instance-id: foo", "#cloud-config\n# \u00e4\n".encode("utf-8")
+    )
+
+    iso = pycdlib.PyCdlib()
+
+    iso.open_fp(iso_fp)
+
+    file_data = BytesIO()
+    iso.get_file_from_iso_fp(file_data, joliet_path="/user-data")
+
+    assert file_data.getvalue().decode("utf-8") == "#cloud-config\n# \u00e4\n"
@@ -1,48 +1,44 @@
 # MIT license
 # Copyright 2022 Sergej Alikov <sergej.alikov@gmail.com>
 
-from libvirt_instance import util
-
-
-def test_index_to_drive_name_zero():
-    assert util.index_to_drive_name(0) == "a"
-
-
-def test_index_to_drive_name_1():
-    assert util.index_to_drive_name(1) == "b"
-
-
-def test_index_to_drive_name_26():
-    assert util.index_to_drive_name(26) == "aa"
+import pytest
 
-
-def test_index_to_drive_name_702():
-    assert util.index_to_drive_name(702) == "aaa"
-
-
-def test_index_to_drive_name_18277():
-    assert util.index_to_drive_name(18277) == "zzz"
-
-
-def test_index_to_drive_name_1403():
-    assert util.index_to_drive_name(1403) == "baz"
+from libvirt_instance import util
 
 
-def test_human_size_units_to_bytes_no_units():
-    assert util.human_size_units_to_bytes("12345") == 12345
+@pytest.mark.parametrize(
+    "idx, name",
+    [(0, "a"), (1, "b"), (26, "aa"), (702, "aaa"), (18277, "zzz"), (1403, "baz")],
+)
+def test_index_to_drive_name(idx, name):
+    assert util.index_to_drive_name(idx) == name
 
 
-def test_human_size_units_to_bytes_space():
-    assert util.human_size_units_to_bytes("12345  B") == 12345
+@pytest.mark.parametrize("idx", [0, 1, 25, 26, 702, 1403, 18277])
+def test_drive_name_to_index(idx):
+    assert util.drive_name_to_index(util.index_to_drive_name(idx)) == idx
 
 
-def test_human_size_units_to_bytes_bytes():
-    assert util.human_size_units_to_bytes("12345B") == 12345
+@pytest.mark.parametrize("name", ["", "a1", "A", "ä"])
+def test_drive_name_to_index_invalid(name):
+    with pytest.raises(ValueError):
+        util.drive_name_to_index(name)
 
 
-def test_human_size_units_to_bytes_kilobytes():
-    assert util.human_size_units_to_bytes("12345KB") == 12345000
+@pytest.mark.parametrize(
+    "size, size_bytes",
+    [
+        ("12345", 12345),
+        ("12345  B", 12345),
+        ("12345B", 12345),
+        ("12345KB", 12345000),
+        ("12345KiB", 12641280),
+    ],
+)
+def test_human_size_units_to_bytes(size, size_bytes):
+    assert util.human_size_units_to_bytes(size) == size_bytes
 
 
-def test_human_size_units_to_bytes_kibibytes():
-    assert util.human_size_units_to_bytes("12345KiB") == 12641280
+def test_human_size_units_to_bytes_invalid():
+    with pytest.raises(ValueError):
+        util.human_size_units_to_bytes("12.5GiB")